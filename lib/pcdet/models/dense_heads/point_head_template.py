@@ -1,16 +1,82 @@
+import numba
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from ...ops.roiaware_pool3d import roiaware_pool3d_utils
-from ...utils import common_utils, loss_utils
-import open3d as o3d
+from ...utils import loss_utils
+
+
+@numba.njit(parallel=True, fastmath=True)
+def _assign_labels(box_idx, ext_idx, gt_boxes, num_class, out_cls):
+    """
+    Args:
+        box_idx: (B, N), -1: background
+        ext_idx: (B, N), -1: outside all the extended gt boxes
+        gt_boxes: (B, M, 7)
+        num_class: int
+        out_cls: (B, N), zeros, return value
+    """
+    batch_size, num_points = box_idx.shape
+    for i in numba.prange(batch_size * num_points):
+        b = i // num_points
+        n = i % num_points
+        k = box_idx[b, n]
+        if k < 0:
+            if ext_idx[b, n] >= 0:
+                out_cls[b, n] = -1
+            continue
+        out_cls[b, n] = 1 if num_class == 1 else int(gt_boxes[b, k, 6])
+
+
+@torch.jit.script
+def part_labels_of_points(local_points: torch.Tensor, ry: torch.Tensor, lhw: torch.Tensor) -> torch.Tensor:
+    """
+    Args:
+        local_points: (N, 3) points minus the center of their gt box
+        ry: (N), heading of their gt box
+        lhw: (N, 3)
+    Returns:
+        part_labels: (N, 3), intra-object part locations in [0, 1]
+    """
+    # same as rotate_points_along_y with angle -ry, scripted so the elementwise ops get fused
+    # this is the reference for the part labels, assign_point_targets_gpu is checked against it
+    cosa = torch.cos(-ry)
+    sina = torch.sin(-ry)
+    x = local_points[:, 0] * cosa - local_points[:, 2] * sina
+    z = local_points[:, 0] * sina + local_points[:, 2] * cosa
+    return torch.stack([x, local_points[:, 1], z], dim=1) / lhw + 0.5
+
+
+def assign_labels_cpu(box_idxs_of_pts, extend_box_idxs_of_pts, gt_boxes, num_class):
+    """
+    Args:
+        box_idxs_of_pts: (B, N), -1: background
+        extend_box_idxs_of_pts: (B, N), -1: outside all the extended gt boxes
+        gt_boxes: (B, M, 7)
+        num_class: int
+    Returns:
+        point_cls_labels: (B, N), long type, 0:background, -1:ignored
+    """
+    point_cls_labels = np.zeros(box_idxs_of_pts.shape, dtype=np.int64)
+    _assign_labels(
+        box_idxs_of_pts.cpu().numpy(), extend_box_idxs_of_pts.cpu().numpy(),
+        gt_boxes.float().cpu().numpy(), num_class, point_cls_labels
+    )
+    return torch.from_numpy(point_cls_labels).to(box_idxs_of_pts.device)
+
 
 class PointHeadTemplate(nn.Module):
     def __init__(self, model_cfg, num_class):
         super().__init__()
         self.model_cfg = model_cfg
         self.num_class = num_class
+        self.assign_targets_on_cpu = model_cfg.get('ASSIGN_TARGETS_ON_CPU', False)
+        # assign_point_targets_gpu needs the roiaware_pool3d_cuda extension rebuilt from this tree
+        self.use_fused_target_assign = model_cfg.get('USE_FUSED_TARGET_ASSIGN', False)
+        # the grid setup of the hashed points-in-boxes lookup only pays off with many boxes per scene
+        self.hashed_points_in_boxes_min_boxes = model_cfg.get('HASHED_POINTS_IN_BOXES_MIN_BOXES', 256)
 
         #self.build_losses(self.model_cfg.LOSS_CONFIG)
         self.forward_ret_dict = None
@@ -46,6 +112,47 @@ class PointHeadTemplate(nn.Module):
         fc_layers.append(nn.Linear(c_in, output_channels, bias=True))
         return nn.Sequential(*fc_layers)
 
+    @staticmethod
+    @torch.no_grad()
+    def fuse_linear_bn(fc_layers):
+        """
+        Fold every Linear + BatchNorm1d pair into a single Linear, only valid for inference
+        Args:
+            fc_layers: nn.Sequential built by make_fc_layers
+        Returns:
+            fused_layers: nn.Sequential
+        """
+        layers = list(fc_layers.children())
+        fused_layers = []
+        k = 0
+        while k < len(layers):
+            if isinstance(layers[k], nn.Linear) and k + 1 < len(layers) and isinstance(layers[k + 1], nn.BatchNorm1d):
+                linear, bn = layers[k], layers[k + 1]
+                scale = bn.weight / torch.sqrt(bn.running_var + bn.eps) #gamma / sqrt(var + eps)
+                bias = linear.bias if linear.bias is not None else torch.zeros_like(bn.running_mean)
+                fused = nn.Linear(linear.in_features, linear.out_features, bias=True).to(linear.weight.device)
+                fused.weight.copy_(linear.weight * scale.unsqueeze(dim=1))
+                fused.bias.copy_(bn.bias + (bias - bn.running_mean) * scale)
+                fused_layers.append(fused)
+                k += 2
+            else:
+                fused_layers.append(layers[k])
+                k += 1
+        return nn.Sequential(*fused_layers)
+
+    def points_in_boxes(self, points, boxes, box_idxs_of_pts=None):
+        """
+        Args:
+            points: (B, N, 3)
+            boxes: (B, M, 7)
+            box_idxs_of_pts: optional (B, N) known assignment, see points_in_boxes_gpu
+        Returns:
+            box_idxs_of_pts: (B, N), default background = -1
+        """
+        if boxes.shape[1] >= self.hashed_points_in_boxes_min_boxes:
+            return roiaware_pool3d_utils.points_in_boxes_gpu_hashed(points, boxes, box_idxs_of_pts=box_idxs_of_pts)
+        return roiaware_pool3d_utils.points_in_boxes_gpu(points, boxes, box_idxs_of_pts=box_idxs_of_pts)
+
     def assign_stack_targets(self, points, gt_boxes, extend_gt_boxes=None,
                              ret_box_labels=False, ret_part_labels=False,
                              set_ignore_flag=True, use_ball_constraint=False, central_radius=2.0):
@@ -59,96 +166,97 @@ class PointHeadTemplate(nn.Module):
             point_part_labels: (BN, 3)
             point_box_labels: (BN, 8) x,y,z,h,w,l,conry sinry
         """
-        batch_size = gt_boxes.shape[0]
-        tmp = torch.cuda.FloatTensor(batch_size, points.shape[1], 4).zero_()
-        for i in range(batch_size):
-            tmp[i, :, 0] = i
-            tmp[i, :, 1:4] = points[i, :, 0:3]
-        points=tmp.view(-1,4)
-
-        assert len(points.shape) == 2 and points.shape[1] == 4, 'points.shape=%s' % str(points.shape)
+        assert len(points.shape) == 3 and points.shape[2] >= 3, 'points.shape=%s' % str(points.shape)
         assert len(gt_boxes.shape) == 3 and gt_boxes.shape[2] == 7, 'gt_boxes.shape=%s' % str(gt_boxes.shape)
         assert extend_gt_boxes is None or len(extend_gt_boxes.shape) == 3 and extend_gt_boxes.shape[2] == 7, \
             'extend_gt_boxes.shape=%s' % str(extend_gt_boxes.shape)
         assert set_ignore_flag != use_ball_constraint, 'Choose one only!'
-        batch_size = gt_boxes.shape[0]
-        bs_idx = points[:, 0]
-        point_cls_labels = points.new_zeros(points.shape[0]).long() #[BN]
-        point_box_labels = gt_boxes.new_zeros((points.shape[0], 8)) if ret_box_labels else None #[BN,8]
-        point_part_labels = gt_boxes.new_zeros((points.shape[0], 3)) if ret_part_labels else None #[BN,3]
-        for k in range(batch_size):
-            bs_mask = (bs_idx == k)
-            points_single = points[bs_mask][:, 1:4]#[N,3]
-
-            point_cls_labels_single = point_cls_labels.new_zeros(bs_mask.sum()) #N
-            box_idxs_of_pts = roiaware_pool3d_utils.points_in_boxes_gpu(
-                points_single.unsqueeze(dim=0), gt_boxes[k:k + 1, :, 0:7].contiguous()
-            ).long().squeeze(dim=0) #N, elem in -1,0,...M-1
-            box_fg_flag = (box_idxs_of_pts >= 0)
-            #显示效果
-            # print(gt_boxes[k:k+1,:,0:7])
-            # points1 = points_single.cpu().numpy()
-            # pcd1 = o3d.geometry.PointCloud()
-            # pcd1.points = o3d.utility.Vector3dVector(points1)
-            # pcd1.paint_uniform_color([0.5, 0.5, 0.5])
-            # point_fg = points_single[box_fg_flag].cpu().numpy()
-            # pcd2 = o3d.geometry.PointCloud()
-            # pcd2.points = o3d.utility.Vector3dVector(point_fg)
-            # pcd2.paint_uniform_color([0, 1, 0])
-            # o3d.visualization.draw_geometries([pcd1,pcd2],window_name='cloud and color',width=800,height=600)
-
-            if set_ignore_flag: #True
-                extend_box_idxs_of_pts = roiaware_pool3d_utils.points_in_boxes_gpu(
-                    points_single.unsqueeze(dim=0), extend_gt_boxes[k:k+1, :, 0:7].contiguous()
-                ).long().squeeze(dim=0)
-                fg_flag = box_fg_flag
-                ignore_flag = fg_flag ^ (extend_box_idxs_of_pts >= 0)
-                point_cls_labels_single[ignore_flag] = -1
-            elif use_ball_constraint:
-                box_centers = gt_boxes[k][box_idxs_of_pts][:, 0:3].clone()
-                box_centers[:, 2] += gt_boxes[k][box_idxs_of_pts][:, 5] / 2
-                ball_flag = ((box_centers - points_single).norm(dim=1) < central_radius)
-                fg_flag = box_fg_flag & ball_flag
-            else:
-                raise NotImplementedError
-
-            gt_box_of_fg_points = gt_boxes[k][box_idxs_of_pts[fg_flag]]
-
-            point_cls_labels_single[fg_flag] = 1 if self.num_class == 1 else gt_box_of_fg_points[:, -1].long()
-            point_cls_labels[bs_mask] = point_cls_labels_single #16384 elem in [-1,0,1]
-            #print(point_cls_labels_single.shape)
-
-            if ret_box_labels and gt_box_of_fg_points.shape[0] > 0:
-                point_box_labels_single = point_box_labels.new_zeros((bs_mask.sum(), 8))
-                # fg_point_box_labels = self.box_coder.encode_torch(
-                #     gt_boxes=gt_box_of_fg_points[:, :-1], points=points_single[fg_flag],
-                #     gt_classes=gt_box_of_fg_points[:, -1].long()
-                # )
-                fg_point_box_labels = self.box_coder.encode_torch(
-                    gt_boxes=gt_box_of_fg_points, points=points_single[fg_flag]
-                )
-                point_box_labels_single[fg_flag] = fg_point_box_labels
-                point_box_labels[bs_mask] = point_box_labels_single
-
-            if ret_part_labels:
-                point_part_labels_single = point_part_labels.new_zeros((bs_mask.sum(), 3)) #[N,3]
-                transformed_points = points_single[fg_flag] - gt_box_of_fg_points[:, 0:3]
-                transformed_points = common_utils.rotate_points_along_y(
-                    transformed_points.view(-1, 3), -gt_box_of_fg_points[:, 6]
-                )
-                #print(transformed_points)
-                # transformed_points = common_utils.rotate_points_along_z(
-                #     transformed_points.view(-1, 1, 3), -gt_box_of_fg_points[:, 6]
-                # ).view(-1, 3)
-                offset = torch.tensor([0.5, 0.5, 0.5]).view(1, 3).type_as(transformed_points)
-                gt_box_of_fg_points_lhw=torch.cat([gt_box_of_fg_points[:,5].view(-1,1),gt_box_of_fg_points[:,3].view(-1,1),gt_box_of_fg_points[:,4].view(-1,1)],dim=1)
-                point_part_labels_single[fg_flag] = (transformed_points / gt_box_of_fg_points_lhw) + offset
-                point_part_labels[bs_mask] = point_part_labels_single
+        # labels stay (B, N, ...) so that every write is a plain (B, N) mask, they are flattened on return
+        batch_size, num_points = points.shape[0], points.shape[1]
+        points = points[:, :, 0:3].contiguous() #[B,N,3]
+
+        # with the ignore flag a single kernel finds the gt box of each point and writes its cls flag and part label,
+        # scenes with more boxes than fit in its shared memory or than the hashed lookup threshold use points_in_boxes
+        num_boxes = gt_boxes.shape[1]
+        use_fused_kernel = set_ignore_flag and self.use_fused_target_assign and not self.assign_targets_on_cpu \
+            and num_boxes <= roiaware_pool3d_utils.ASSIGN_POINT_TARGETS_MAX_BOXES \
+            and num_boxes < self.hashed_points_in_boxes_min_boxes
+        if use_fused_kernel:
+            box_idxs_of_pts, point_cls_labels, point_part_labels = roiaware_pool3d_utils.assign_point_targets_gpu(
+                points, gt_boxes[:, :, 0:7].contiguous(), extend_gt_boxes[:, :, 0:7].contiguous()
+            )
+            point_cls_labels = point_cls_labels.long() #[B,N], elem in [-1,0,1]
+        else:
+            # the kernel handles the whole batch at once, no need to loop over the samples
+            box_idxs_of_pts = self.points_in_boxes(points, gt_boxes[:, :, 0:7].contiguous())
+        box_idxs_of_pts = box_idxs_of_pts.long() #[B,N], elem in -1,0,...M-1
+        box_fg_flag = (box_idxs_of_pts >= 0)
+        gt_box_of_pts = gt_boxes.gather(
+            1, box_idxs_of_pts.clamp(min=0).unsqueeze(dim=-1).expand(-1, -1, gt_boxes.shape[-1])
+        ) #[B,N,7], only meaningful where box_fg_flag is set
+        #显示效果
+        # import open3d as o3d
+        # print(gt_boxes[0:1,:,0:7])
+        # points1 = points[0].cpu().numpy()
+        # pcd1 = o3d.geometry.PointCloud()
+        # pcd1.points = o3d.utility.Vector3dVector(points1)
+        # pcd1.paint_uniform_color([0.5, 0.5, 0.5])
+        # point_fg = points[0][box_fg_flag[0]].cpu().numpy()
+        # pcd2 = o3d.geometry.PointCloud()
+        # pcd2.points = o3d.utility.Vector3dVector(point_fg)
+        # pcd2.paint_uniform_color([0, 1, 0])
+        # o3d.visualization.draw_geometries([pcd1,pcd2],window_name='cloud and color',width=800,height=600)
+
+        if use_fused_kernel:
+            fg_flag = box_fg_flag
+        elif set_ignore_flag:
+            # the extended boxes contain the gt boxes, so only the background points need to be tested
+            extend_box_idxs_of_pts = self.points_in_boxes(
+                points, extend_gt_boxes[:, :, 0:7].contiguous(), box_idxs_of_pts=box_idxs_of_pts
+            ).long()
+            fg_flag = box_fg_flag
+            # for small batches the cls labels are cheaper to write in one cpu pass than with many tiny kernels
+            point_cls_labels = assign_labels_cpu(
+                box_idxs_of_pts, extend_box_idxs_of_pts, gt_boxes, num_class=self.num_class
+            )
+        elif use_ball_constraint:
+            box_centers = gt_box_of_pts[:, :, 0:3].clone()
+            box_centers[:, :, 2] += gt_box_of_pts[:, :, 5] / 2
+            ball_flag = ((box_centers - points).norm(dim=-1) < central_radius)
+            fg_flag = box_fg_flag & ball_flag
+            point_cls_labels = box_idxs_of_pts.new_zeros((batch_size, num_points)) #[B,N]
+            point_cls_labels[fg_flag] = 1
+        else:
+            raise NotImplementedError
+
+        gt_box_of_fg_points = gt_box_of_pts[fg_flag] #[N_fg,7]
+        if self.num_class != 1:
+            point_cls_labels[fg_flag] = gt_box_of_fg_points[:, -1].long()
+
+        point_box_labels = gt_boxes.new_zeros((batch_size, num_points, 8)) if ret_box_labels else None #[B,N,8]
+        if ret_box_labels and gt_box_of_fg_points.shape[0] > 0:
+            # fg_point_box_labels = self.box_coder.encode_torch(
+            #     gt_boxes=gt_box_of_fg_points[:, :-1], points=points[fg_flag],
+            #     gt_classes=gt_box_of_fg_points[:, -1].long()
+            # )
+            fg_point_box_labels = self.box_coder.encode_torch(
+                gt_boxes=gt_box_of_fg_points, points=points[fg_flag]
+            )
+            point_box_labels[fg_flag] = fg_point_box_labels
+
+        if not ret_part_labels:
+            point_part_labels = None
+        elif not use_fused_kernel:
+            point_part_labels = gt_boxes.new_zeros((batch_size, num_points, 3)) #[B,N,3]
+            gt_box_of_fg_points_lhw = gt_box_of_fg_points[:, [5, 3, 4]] #[N_fg,3]
+            point_part_labels[fg_flag] = part_labels_of_points(
+                points[fg_flag] - gt_box_of_fg_points[:, 0:3], gt_box_of_fg_points[:, 6], gt_box_of_fg_points_lhw
+            )
 
         targets_dict = {
-            'point_cls_labels': point_cls_labels,
-            'point_box_labels': point_box_labels,
-            'point_part_labels': point_part_labels
+            'point_cls_labels': point_cls_labels.view(-1),
+            'point_box_labels': point_box_labels.view(-1, 8) if point_box_labels is not None else None,
+            'point_part_labels': point_part_labels.view(-1, 3) if point_part_labels is not None else None
         }
         return targets_dict
 
@@ -157,14 +265,12 @@ class PointHeadTemplate(nn.Module):
         point_cls_preds = self.forward_ret_dict['point_cls_preds'].view(-1, self.num_class)
 
         positives = (point_cls_labels > 0)
-        negative_cls_weights = (point_cls_labels == 0) * 1.0
-        cls_weights = (negative_cls_weights + 1.0 * positives).float()
         pos_normalizer = positives.sum(dim=0).float()
-        cls_weights /= torch.clamp(pos_normalizer, min=1.0)
+        #negatives + positives, ignored points get 0
+        cls_weights = (point_cls_labels >= 0).float() * pos_normalizer.clamp(min=1.0).reciprocal()
 
-        one_hot_targets = point_cls_preds.new_zeros(*list(point_cls_labels.shape), self.num_class + 1)
-        one_hot_targets.scatter_(-1, (point_cls_labels * (point_cls_labels >= 0).long()).unsqueeze(dim=-1).long(), 1.0)
-        one_hot_targets = one_hot_targets[..., 1:]
+        one_hot_targets = F.one_hot(point_cls_labels.clamp(min=0), self.num_class + 1)[..., 1:]
+        one_hot_targets = one_hot_targets.to(point_cls_preds.dtype)
         cls_loss_src = self.cls_loss_func(point_cls_preds, one_hot_targets, weights=cls_weights)
         point_loss_cls = cls_loss_src.sum()
 
@@ -172,18 +278,20 @@ class PointHeadTemplate(nn.Module):
         point_loss_cls = point_loss_cls * loss_weights_dict['point_cls_weight']
         if tb_dict is None:
             tb_dict = {}
+        # fetch both scalars with a single device sync
+        loss_cls_value, pos_num = torch.stack([point_loss_cls.detach(), pos_normalizer]).tolist()
         tb_dict.update({
-            'point_loss_cls': point_loss_cls.item(),
-            'point_pos_num': pos_normalizer.item()
+            'point_loss_cls': loss_cls_value,
+            'point_pos_num': pos_num
         })
         return point_loss_cls, tb_dict
 
     def get_part_layer_loss(self, tb_dict=None):
         pos_mask = self.forward_ret_dict['point_cls_labels'] > 0
-        pos_normalizer = max(1, (pos_mask > 0).sum().item())
+        pos_normalizer = pos_mask.sum().clamp(min=1).float()
         point_part_labels = self.forward_ret_dict['point_part_labels']
         point_part_preds = self.forward_ret_dict['point_part_preds']
-        point_loss_part = F.binary_cross_entropy(torch.sigmoid(point_part_preds), point_part_labels, reduction='none')
+        point_loss_part = F.binary_cross_entropy_with_logits(point_part_preds, point_part_labels, reduction='none')
         point_loss_part = (point_loss_part.sum(dim=-1) * pos_mask.float()).sum() / (3 * pos_normalizer)
 
         loss_weights_dict = self.model_cfg.LOSS_CONFIG.LOSS_WEIGHTS
@@ -198,9 +306,7 @@ class PointHeadTemplate(nn.Module):
         point_box_labels = self.forward_ret_dict['point_box_labels']
         point_box_preds = self.forward_ret_dict['point_box_preds']
 
-        reg_weights = pos_mask.float()
-        pos_normalizer = pos_mask.sum().float()
-        reg_weights /= torch.clamp(pos_normalizer, min=1.0)
+        reg_weights = pos_mask.float() * pos_mask.sum().float().clamp(min=1.0).reciprocal()
 
         point_loss_box_src = self.reg_loss_func(
             point_box_preds[None, ...], point_box_labels[None, ...], weights=reg_weights[None, ...]
@@ -225,7 +331,10 @@ class PointHeadTemplate(nn.Module):
             point_box_preds: (N, box_code_size)
 
         """
-        _, pred_classes = point_cls_preds.max(dim=-1)
+        if self.num_class == 1:
+            pred_classes = point_cls_preds.new_zeros(point_cls_preds.shape[0], dtype=torch.long)
+        else:
+            _, pred_classes = point_cls_preds.max(dim=-1)
         point_box_preds = self.box_coder.decode_torch(point_box_preds, points, pred_classes + 1)#(BN,7)
 
         return point_cls_preds, point_box_preds
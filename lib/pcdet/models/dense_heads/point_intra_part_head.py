@@ -36,6 +36,34 @@ class PointIntraPartOffsetHead(PointHeadTemplate):
             )
         else:
             self.box_layers = None
+        # run the fc stacks under bf16 autocast, needs torch.cuda.amp with bf16 support (torch >= 1.10)
+        self.use_amp = self.model_cfg.get('USE_AMP', False)
+        # fuse the fc stacks and the sigmoid/max tail with torch.compile (torch >= 2.0), needs a fixed number of points
+        # the unbound function is compiled and called with the module, so DataParallel replicas use their own weights
+        self.compiled_predict_points = None
+        if self.model_cfg.get('USE_TORCH_COMPILE', False):
+            self.compiled_predict_points = torch.compile(
+                PointIntraPartOffsetHead.predict_points, mode='reduce-overhead', dynamic=False
+            )
+        self.fc_layers_fused = False
+
+    def fuse_fc_layers(self):
+        """
+        Fold the BatchNorm1d layers of the fc stacks into their Linear layers for inference.
+        Call it after the weights are loaded and the model is in eval mode, the head can not be trained afterwards.
+        Nothing in the repo calls it, inference scripts opt in after loading the checkpoint.
+        """
+        assert not self.training, 'fuse_fc_layers is only valid in eval mode'
+        self.cls_layers = self.fuse_linear_bn(self.cls_layers)
+        self.part_reg_layers = self.fuse_linear_bn(self.part_reg_layers)
+        if self.box_layers is not None:
+            self.box_layers = self.fuse_linear_bn(self.box_layers)
+        self.fc_layers_fused = True
+
+    def train(self, mode=True):
+        # the BatchNorm1d layers are gone after fuse_fc_layers, training would silently run without them
+        assert not (mode and self.fc_layers_fused), 'can not train the head after fuse_fc_layers'
+        return super().train(mode)
 
     def assign_targets(self, input_dict):
         """
@@ -76,6 +104,41 @@ class PointIntraPartOffsetHead(PointHeadTemplate):
             point_loss += point_loss_box
         return point_loss, tb_dict
 
+    def predict_points(self, point_features):
+        """
+        Args:
+            point_features: (BN, C)
+        Returns:
+            ret_dict:
+                point_cls_preds: (BN, num_class)
+                point_part_preds: (BN, 3)
+                point_box_preds: (BN, 8), only with box_layers
+                point_cls_scores: (BN)
+                point_part_offset: (BN, 3)
+        """
+        if self.use_amp:
+            with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+                point_cls_preds = self.cls_layers(point_features)
+                point_part_preds = self.part_reg_layers(point_features)
+                point_box_preds = self.box_layers(point_features) if self.box_layers is not None else None
+            # back to fp32 for the sigmoids, the target assignment and the losses
+            point_cls_preds, point_part_preds = point_cls_preds.float(), point_part_preds.float()
+            point_box_preds = point_box_preds.float() if point_box_preds is not None else None
+        else:
+            point_cls_preds = self.cls_layers(point_features)  #[BN,1] (total_points, num_class)
+            point_part_preds = self.part_reg_layers(point_features) #[BN,3]
+            point_box_preds = self.box_layers(point_features) if self.box_layers is not None else None #[BN,8]
+
+        ret_dict = {
+            'point_cls_preds': point_cls_preds,
+            'point_part_preds': point_part_preds,
+            'point_part_offset': torch.sigmoid(point_part_preds)
+        }
+        ret_dict['point_cls_scores'], _ = torch.sigmoid(point_cls_preds).max(dim=-1)
+        if point_box_preds is not None:
+            ret_dict['point_box_preds'] = point_box_preds
+        return ret_dict
+
     def forward(self, batch_dict):
         """
         Args:
@@ -88,22 +151,12 @@ class PointIntraPartOffsetHead(PointHeadTemplate):
                 point_cls_scores: (N1 + N2 + N3 + ..., 1)
                 point_part_offset: (N1 + N2 + N3 + ..., 3)
         """
-        point_features = batch_dict['backbone_features'].transpose(1,2).contiguous().view(-1,128) #(BN,128)
-        point_cls_preds = self.cls_layers(point_features)  #[BN,1] (total_points, num_class)
-        point_part_preds = self.part_reg_layers(point_features) #[BN,3]
-
-        batch_dict['point_cls_preds'] = point_cls_preds
-        batch_dict['point_part_preds'] = point_part_preds
-
-        if self.box_layers is not None:
-            point_box_preds = self.box_layers(point_features) #[BN,8]
-            batch_dict['point_box_preds'] = point_box_preds
-        #print(point_cls_preds.shape,point_part_preds.shape,point_box_preds.shape)
-
-        point_cls_scores = torch.sigmoid(point_cls_preds)
-        point_part_offset = torch.sigmoid(point_part_preds)
-        batch_dict['point_cls_scores'], _ = point_cls_scores.max(dim=-1)
-        batch_dict['point_part_offset'] = point_part_offset
+        point_features = batch_dict['backbone_features'].permute(0, 2, 1).reshape(-1, 128) #(BN,128)
+        if self.compiled_predict_points is not None:
+            batch_dict.update(self.compiled_predict_points(self, point_features))
+        else:
+            batch_dict.update(self.predict_points(point_features))
+        point_cls_preds = batch_dict['point_cls_preds']
 
         if self.training:
             targets_dict = self.assign_targets(batch_dict)
@@ -25,22 +25,127 @@ def points_in_boxes_cpu(points, boxes):
     return point_indices.numpy() if is_numpy else point_indices
 
 
-def points_in_boxes_gpu(points, boxes):
+def points_in_boxes_gpu(points, boxes, box_idxs_of_pts=None):
     """
     :param points: (B, M, 3)
     :param boxes: (B, T, 7), num_valid_boxes <= T
+    :param box_idxs_of_pts: optional (B, M) known assignment, points with an index >= 0 keep it and are not tested,
+        e.g. the gt box indices when testing against the enlarged gt boxes
     :return box_idxs_of_pts: (B, M), default background = -1
     """
     assert boxes.shape[0] == points.shape[0]
     assert boxes.shape[2] == 7 and points.shape[2] == 3
     batch_size, num_points, _ = points.shape
 
-    box_idxs_of_pts = points.new_zeros((batch_size, num_points), dtype=torch.int).fill_(-1)
+    if box_idxs_of_pts is None:
+        box_idxs_of_pts = points.new_zeros((batch_size, num_points), dtype=torch.int).fill_(-1)
+    else:
+        assert box_idxs_of_pts.shape == (batch_size, num_points)
+        box_idxs_of_pts = box_idxs_of_pts.to(dtype=torch.int, copy=True).contiguous()
     roiaware_pool3d_cuda.points_in_boxes_gpu(boxes.contiguous(), points.contiguous(), box_idxs_of_pts)
 
     return box_idxs_of_pts
 
 
+def points_in_boxes_gpu_hashed(points, boxes, box_idxs_of_pts=None, max_grid_size=256):
+    """
+    Same result as points_in_boxes_gpu, but the boxes are first bucketed in a BEV grid so that each point only
+    tests the few boxes whose bounding circle overlaps its cell instead of all the T boxes
+    :param points: (B, M, 3)
+    :param boxes: (B, T, 7), num_valid_boxes <= T
+    :param box_idxs_of_pts: optional (B, M) known assignment, points with an index >= 0 keep it and are not tested
+    :param max_grid_size: upper bound of the grid cells along x and y
+    :return box_idxs_of_pts: (B, M), default background = -1
+    """
+    assert boxes.shape[0] == points.shape[0]
+    assert boxes.shape[2] == 7 and points.shape[2] == 3
+    batch_size, num_points, _ = points.shape
+    num_boxes = boxes.shape[1]
+
+    # bounding circle of each box in BEV, with the margin of the inside test
+    box_centers = boxes[:, :, 0:2]
+    box_radius = ((boxes[:, :, 3:5] / 2 + 1e-3) ** 2).sum(dim=-1).sqrt() #(B,T)
+    grid_min = torch.min(points[:, :, 0:2].reshape(-1, 2).min(dim=0)[0],
+                         (box_centers - box_radius.unsqueeze(dim=-1)).reshape(-1, 2).min(dim=0)[0])
+    grid_max = torch.max(points[:, :, 0:2].reshape(-1, 2).max(dim=0)[0],
+                         (box_centers + box_radius.unsqueeze(dim=-1)).reshape(-1, 2).max(dim=0)[0])
+    # a cell is at least as large as every box, so each box falls into at most 2x2 cells
+    cell_size = torch.stack([
+        box_radius.max() * 2, (grid_max - grid_min).max() / max_grid_size, box_radius.new_tensor(1e-2)
+    ]).max()
+    grid_size = ((grid_max - grid_min) / cell_size).floor() + 1
+    # the only device sync of the grid setup
+    cell_size, grid_min_x, grid_min_y, grid_x, grid_y = torch.cat([cell_size.view(1), grid_min, grid_size]).tolist()
+    grid_x, grid_y = int(grid_x), int(grid_y)
+    num_cells = batch_size * grid_y * grid_x
+    grid_min = boxes.new_tensor([grid_min_x, grid_min_y])
+
+    cell_min = ((box_centers - box_radius.unsqueeze(dim=-1) - grid_min) / cell_size).floor().long() #(B,T,2)
+    cell_max = ((box_centers + box_radius.unsqueeze(dim=-1) - grid_min) / cell_size).floor().long()
+    offsets = cell_min.new_tensor([[0, 0], [1, 0], [0, 1], [1, 1]]) #(4,2)
+    box_cells = cell_min.unsqueeze(dim=2) + offsets #(B,T,4,2)
+    valid_mask = (box_cells <= cell_max.unsqueeze(dim=2)).all(dim=-1) #(B,T,4)
+    bs_idx = torch.arange(batch_size, device=boxes.device).view(-1, 1, 1).expand_as(valid_mask)
+    box_idx = torch.arange(num_boxes, device=boxes.device).view(1, -1, 1).expand_as(valid_mask)
+    cell_idx = (bs_idx * grid_y + box_cells[..., 1]) * grid_x + box_cells[..., 0]
+    # unused (box, cell) pairs go to an extra bucket after the last cell instead of being masked out,
+    # a boolean mask index would need a sync for its output size
+    cell_idx = torch.where(valid_mask, cell_idx, torch.full_like(cell_idx, num_cells)).view(-1)
+    box_idx = box_idx.reshape(-1)
+
+    # CSR buckets: the boxes of each cell are stored in increasing index order, like the brute-force search
+    _, order = (cell_idx * num_boxes + box_idx).sort()
+    cell_box_idxs = box_idx[order].int().contiguous()
+    # scatter_add_ instead of bincount, the cuda bincount reads the max value back to the host
+    cell_counts = cell_idx.new_zeros(num_cells + 1).scatter_add_(0, cell_idx, torch.ones_like(cell_idx))
+    cell_start = cell_idx.new_zeros(num_cells + 1)
+    cell_start[1:] = cell_counts[:-1].cumsum(dim=0)
+    cell_start = cell_start.int().contiguous()
+
+    if box_idxs_of_pts is None:
+        box_idxs_of_pts = points.new_zeros((batch_size, num_points), dtype=torch.int).fill_(-1)
+    else:
+        assert box_idxs_of_pts.shape == (batch_size, num_points)
+        box_idxs_of_pts = box_idxs_of_pts.to(dtype=torch.int, copy=True).contiguous()
+    roiaware_pool3d_cuda.points_in_boxes_hashed_gpu(
+        boxes.contiguous(), points.contiguous(), cell_start, cell_box_idxs, box_idxs_of_pts,
+        grid_x, grid_y, grid_min_x, grid_min_y, cell_size
+    )
+
+    return box_idxs_of_pts
+
+
+# both box sets of assign_point_targets_gpu are staged in shared memory (48KB per block)
+ASSIGN_POINT_TARGETS_MAX_BOXES = 48 * 1024 // (2 * 7 * 4)
+
+
+def assign_point_targets_gpu(points, gt_boxes, extend_gt_boxes):
+    """
+    Find the gt box of each point and write its cls flag and part label in a single kernel
+    :param points: (B, N, 3)
+    :param gt_boxes: (B, M, 7), num_valid_boxes <= M <= ASSIGN_POINT_TARGETS_MAX_BOXES
+    :param extend_gt_boxes: (B, M, 7), the enlarged gt_boxes
+    :return:
+        box_idxs_of_pts: (B, N), index of the gt box of each point, default background = -1
+        point_cls_labels: (B, N), 1: inside a gt box, -1: only inside an extended gt box, 0: background
+        point_part_labels: (B, N, 3), intra-object part locations of the foreground points, 0 for the others
+    """
+    assert gt_boxes.shape == extend_gt_boxes.shape and gt_boxes.shape[0] == points.shape[0]
+    assert gt_boxes.shape[2] == 7 and points.shape[2] == 3
+    assert gt_boxes.shape[1] <= ASSIGN_POINT_TARGETS_MAX_BOXES, 'too many boxes: %d' % gt_boxes.shape[1]
+    batch_size, num_points, _ = points.shape
+
+    box_idxs_of_pts = points.new_zeros((batch_size, num_points), dtype=torch.int).fill_(-1)
+    point_cls_labels = points.new_zeros((batch_size, num_points), dtype=torch.int)
+    point_part_labels = points.new_zeros((batch_size, num_points, 3))
+    roiaware_pool3d_cuda.assign_point_targets_gpu(
+        gt_boxes.contiguous(), extend_gt_boxes.contiguous(), points.contiguous(),
+        box_idxs_of_pts, point_cls_labels, point_part_labels
+    )
+
+    return box_idxs_of_pts, point_cls_labels, point_part_labels
+
+
 class RoIAwarePool3d(nn.Module):
     def __init__(self, out_size, max_pts_each_voxel=128):
         super().__init__()
@@ -26,6 +26,13 @@ void roiaware_pool3d_backward_launcher(int boxes_num, int out_x, int out_y, int
 void points_in_boxes_launcher(int batch_size, int boxes_num, int pts_num, const float *boxes,
     const float *pts, int *box_idx_of_points);
 
+void points_in_boxes_hashed_launcher(int batch_size, int boxes_num, int pts_num, int grid_x, int grid_y,
+    float grid_min_x, float grid_min_y, float cell_size, const float *boxes, const float *pts,
+    const int *cell_start, const int *cell_box_idxs, int *box_idx_of_points);
+
+void assign_point_targets_launcher(int batch_size, int boxes_num, int pts_num, const float *boxes,
+    const float *extend_boxes, const float *pts, int *box_idx_of_points, int *cls_labels, float *part_labels);
+
 int roiaware_pool3d_gpu(at::Tensor rois, at::Tensor pts, at::Tensor pts_feature, at::Tensor argmax,
     at::Tensor pts_idx_of_voxels, at::Tensor pooled_features, int pool_method){
     // params rois: (N, 7) [x, y, z, dx, dy, dz, heading] (x, y, z) is the box center
@@ -117,6 +124,70 @@ int points_in_boxes_gpu(at::Tensor boxes_tensor, at::Tensor pts_tensor, at::Tens
     return 1;
 }
 
+int points_in_boxes_hashed_gpu(at::Tensor boxes_tensor, at::Tensor pts_tensor, at::Tensor cell_start_tensor,
+    at::Tensor cell_box_idxs_tensor, at::Tensor box_idx_of_points_tensor, int grid_x, int grid_y,
+    float grid_min_x, float grid_min_y, float cell_size){
+    // params boxes: (B, N, 7) [x, y, z, dx, dy, dz, heading] (x, y, z) is the box center
+    // params pts: (B, npoints, 3) [x, y, z]
+    // params cell_start: (B * grid_y * grid_x + 1), offsets of the boxes of each BEV cell in cell_box_idxs
+    // params cell_box_idxs: (num_box_cells), box indices sorted by cell and then by box index
+    // params boxes_idx_of_points: (B, npoints), default -1
+
+//    CHECK_INPUT(boxes_tensor);
+//    CHECK_INPUT(pts_tensor);
+//    CHECK_INPUT(cell_start_tensor);
+//    CHECK_INPUT(cell_box_idxs_tensor);
+//    CHECK_INPUT(box_idx_of_points_tensor);
+
+    int batch_size = boxes_tensor.size(0);
+    int boxes_num = boxes_tensor.size(1);
+    int pts_num = pts_tensor.size(1);
+
+    const float *boxes = boxes_tensor.data<float>();
+    const float *pts = pts_tensor.data<float>();
+    const int *cell_start = cell_start_tensor.data<int>();
+    const int *cell_box_idxs = cell_box_idxs_tensor.data<int>();
+    int *box_idx_of_points = box_idx_of_points_tensor.data<int>();
+
+    points_in_boxes_hashed_launcher(batch_size, boxes_num, pts_num, grid_x, grid_y, grid_min_x, grid_min_y,
+        cell_size, boxes, pts, cell_start, cell_box_idxs, box_idx_of_points);
+
+    return 1;
+}
+
+int assign_point_targets_gpu(at::Tensor boxes_tensor, at::Tensor extend_boxes_tensor, at::Tensor pts_tensor,
+    at::Tensor box_idx_of_points_tensor, at::Tensor cls_labels_tensor, at::Tensor part_labels_tensor){
+    // params boxes: (B, N, 7) [x, y, z, dx, dy, dz, heading] (x, y, z) is the box center
+    // params extend_boxes: (B, N, 7) the enlarged boxes
+    // params pts: (B, npoints, 3) [x, y, z]
+    // params boxes_idx_of_points: (B, npoints), default -1
+    // params cls_labels: (B, npoints), 1: in a box, -1: only in an enlarged box, 0: background
+    // params part_labels: (B, npoints, 3), default 0
+
+//    CHECK_INPUT(boxes_tensor);
+//    CHECK_INPUT(extend_boxes_tensor);
+//    CHECK_INPUT(pts_tensor);
+//    CHECK_INPUT(box_idx_of_points_tensor);
+//    CHECK_INPUT(cls_labels_tensor);
+//    CHECK_INPUT(part_labels_tensor);
+
+    int batch_size = boxes_tensor.size(0);
+    int boxes_num = boxes_tensor.size(1);
+    int pts_num = pts_tensor.size(1);
+
+    const float *boxes = boxes_tensor.data<float>();
+    const float *extend_boxes = extend_boxes_tensor.data<float>();
+    const float *pts = pts_tensor.data<float>();
+    int *box_idx_of_points = box_idx_of_points_tensor.data<int>();
+    int *cls_labels = cls_labels_tensor.data<int>();
+    float *part_labels = part_labels_tensor.data<float>();
+
+    assign_point_targets_launcher(batch_size, boxes_num, pts_num, boxes, extend_boxes, pts,
+        box_idx_of_points, cls_labels, part_labels);
+
+    return 1;
+}
+
 
 inline void lidar_to_local_coords_cpu(float shift_x, float shift_y, float rot_angle, float &local_x, float &local_y){
     float cosa = cos(-rot_angle), sina = sin(-rot_angle);
@@ -173,5 +244,7 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
     m.def("forward", &roiaware_pool3d_gpu, "roiaware pool3d forward (CUDA)");
     m.def("backward", &roiaware_pool3d_gpu_backward, "roiaware pool3d backward (CUDA)");
     m.def("points_in_boxes_gpu", &points_in_boxes_gpu, "points_in_boxes_gpu forward (CUDA)");
+    m.def("points_in_boxes_hashed_gpu", &points_in_boxes_hashed_gpu, "points_in_boxes_hashed_gpu forward (CUDA)");
+    m.def("assign_point_targets_gpu", &assign_point_targets_gpu, "assign_point_targets_gpu forward (CUDA)");
     m.def("points_in_boxes_cpu", &points_in_boxes_cpu, "points_in_boxes_cpu forward (CUDA)");
 }
@@ -30,6 +30,9 @@ __device__ inline int check_pt_in_box3d(const float *pt, const float *box3d, flo
     float dx = box3d[3], dy = box3d[4], dz = box3d[5], rz = box3d[6];
 
     if (fabsf(z - cz) > dz / 2.0) return 0;
+    // cheap reject before the rotation: the box fits in the circle around its (margin-enlarged) corners
+    float half_dx = dx / 2.0 + MARGIN, half_dy = dy / 2.0 + MARGIN;
+    if ((x - cx) * (x - cx) + (y - cy) * (y - cy) > half_dx * half_dx + half_dy * half_dy) return 0;
     lidar_to_local_coords(x - cx, y - cy, rz, local_x, local_y);
     float in_flag = (fabs(local_x) < dx / 2.0 + MARGIN) & (fabs(local_y) < dy / 2.0 + MARGIN);
     return in_flag;
@@ -314,7 +317,7 @@ __global__ void points_in_boxes_kernel(int batch_size, int boxes_num, int pts_nu
     const float *pts, int *box_idx_of_points){
     // params boxes: (B, N, 7) [x, y, z, dx, dy, dz, heading] (x, y, z) is the box center
     // params pts: (B, npoints, 3) [x, y, z] in LiDAR coordinate
-    // params boxes_idx_of_points: (B, npoints), default -1
+    // params boxes_idx_of_points: (B, npoints), default -1, points with an index >= 0 are skipped
 
     int bs_idx = blockIdx.y;
     int pt_idx = blockIdx.x * blockDim.x + threadIdx.x;
@@ -323,6 +326,7 @@ __global__ void points_in_boxes_kernel(int batch_size, int boxes_num, int pts_nu
     boxes += bs_idx * boxes_num * 7;
     pts += bs_idx * pts_num * 3 + pt_idx * 3;
     box_idx_of_points += bs_idx * pts_num + pt_idx;
+    if (box_idx_of_points[0] >= 0) return;
 
     float local_x = 0, local_y = 0;
     int cur_in_flag = 0;
@@ -357,3 +361,145 @@ void points_in_boxes_launcher(int batch_size, int boxes_num, int pts_num, const
     cudaDeviceSynchronize();  // for using printf in kernel function
 #endif
 }
+
+
+__global__ void points_in_boxes_hashed_kernel(int batch_size, int boxes_num, int pts_num, int grid_x, int grid_y,
+    float grid_min_x, float grid_min_y, float cell_size, const float *boxes, const float *pts,
+    const int *cell_start, const int *cell_box_idxs, int *box_idx_of_points){
+    // params boxes: (B, N, 7) [x, y, z, dx, dy, dz, heading] (x, y, z) is the box center
+    // params pts: (B, npoints, 3) [x, y, z] in LiDAR coordinate
+    // params cell_start: (B * grid_y * grid_x + 1), the boxes of cell i are cell_box_idxs[cell_start[i]:cell_start[i + 1]]
+    // params cell_box_idxs: (num_box_cells), box indices sorted by cell and then by box index
+    // params boxes_idx_of_points: (B, npoints), default -1, points with an index >= 0 are skipped
+
+    int bs_idx = blockIdx.y;
+    int pt_idx = blockIdx.x * blockDim.x + threadIdx.x;
+    if (bs_idx >= batch_size || pt_idx >= pts_num) return;
+
+    boxes += bs_idx * boxes_num * 7;
+    pts += bs_idx * pts_num * 3 + pt_idx * 3;
+    box_idx_of_points += bs_idx * pts_num + pt_idx;
+    if (box_idx_of_points[0] >= 0) return;
+
+    int x_idx = int(floorf((pts[0] - grid_min_x) / cell_size));
+    int y_idx = int(floorf((pts[1] - grid_min_y) / cell_size));
+    if (x_idx < 0 || x_idx >= grid_x || y_idx < 0 || y_idx >= grid_y) return;
+    int cell_idx = (bs_idx * grid_y + y_idx) * grid_x + x_idx;
+
+    float local_x = 0, local_y = 0;
+    for (int j = cell_start[cell_idx]; j < cell_start[cell_idx + 1]; j++){
+        int k = cell_box_idxs[j];
+        if (check_pt_in_box3d(pts, boxes + k * 7, local_x, local_y)){
+            box_idx_of_points[0] = k;
+            break;
+        }
+    }
+}
+
+
+void points_in_boxes_hashed_launcher(int batch_size, int boxes_num, int pts_num, int grid_x, int grid_y,
+    float grid_min_x, float grid_min_y, float cell_size, const float *boxes, const float *pts,
+    const int *cell_start, const int *cell_box_idxs, int *box_idx_of_points){
+    // params boxes: (B, N, 7) [x, y, z, dx, dy, dz, heading] (x, y, z) is the box center
+    // params pts: (B, npoints, 3) [x, y, z]
+    // params cell_start: (B * grid_y * grid_x + 1)
+    // params cell_box_idxs: (num_box_cells)
+    // params boxes_idx_of_points: (B, npoints), default -1
+    cudaError_t err;
+
+    dim3 blocks(DIVUP(pts_num, THREADS_PER_BLOCK), batch_size);
+    dim3 threads(THREADS_PER_BLOCK);
+    points_in_boxes_hashed_kernel<<<blocks, threads>>>(batch_size, boxes_num, pts_num, grid_x, grid_y,
+        grid_min_x, grid_min_y, cell_size, boxes, pts, cell_start, cell_box_idxs, box_idx_of_points);
+
+    err = cudaGetLastError();
+    if (cudaSuccess != err) {
+        fprintf(stderr, "CUDA kernel failed : %s\n", cudaGetErrorString(err));
+        exit(-1);
+    }
+
+#ifdef DEBUG
+    cudaDeviceSynchronize();  // for using printf in kernel function
+#endif
+}
+
+
+__global__ void assign_point_targets_kernel(int batch_size, int boxes_num, int pts_num, const float *boxes,
+    const float *extend_boxes, const float *pts, int *box_idx_of_points, int *cls_labels, float *part_labels){
+    // params boxes: (B, N, 7) [x, y, z, dx, dy, dz, heading] (x, y, z) is the box center
+    // params extend_boxes: (B, N, 7) the enlarged boxes
+    // params pts: (B, npoints, 3) [x, y, z] in LiDAR coordinate
+    // params boxes_idx_of_points: (B, npoints), default -1
+    // params cls_labels: (B, npoints), 1: in a box, -1: only in an enlarged box, 0: background
+    // params part_labels: (B, npoints, 3), default 0
+    extern __shared__ float shared_boxes[];  // boxes_num * 7 boxes followed by boxes_num * 7 enlarged boxes
+    float *shared_extend_boxes = shared_boxes + boxes_num * 7;
+
+    int bs_idx = blockIdx.y;
+    int pt_idx = blockIdx.x * blockDim.x + threadIdx.x;
+    if (bs_idx >= batch_size) return;
+
+    boxes += bs_idx * boxes_num * 7;
+    extend_boxes += bs_idx * boxes_num * 7;
+    for (int k = threadIdx.x; k < boxes_num * 7; k += blockDim.x){
+        shared_boxes[k] = boxes[k];
+        shared_extend_boxes[k] = extend_boxes[k];
+    }
+    __syncthreads();
+    if (pt_idx >= pts_num) return;
+
+    pts += bs_idx * pts_num * 3 + pt_idx * 3;
+    box_idx_of_points += bs_idx * pts_num + pt_idx;
+    cls_labels += bs_idx * pts_num + pt_idx;
+    part_labels += bs_idx * pts_num * 3 + pt_idx * 3;
+
+    float local_x = 0, local_y = 0;
+    for (int k = 0; k < boxes_num; k++){
+        const float *cur_box = shared_boxes + k * 7;
+        if (check_pt_in_box3d(pts, cur_box, local_x, local_y)){
+            box_idx_of_points[0] = k;
+            cls_labels[0] = 1;
+            // same as rotate_points_along_y(pts - center, -heading) / (box[5], box[3], box[4]) + 0.5
+            float shift_x = pts[0] - cur_box[0], shift_y = pts[1] - cur_box[1], shift_z = pts[2] - cur_box[2];
+            float cosa = cos(-cur_box[6]), sina = sin(-cur_box[6]);
+            part_labels[0] = (shift_x * cosa - shift_z * sina) / cur_box[5] + 0.5;
+            part_labels[1] = shift_y / cur_box[3] + 0.5;
+            part_labels[2] = (shift_x * sina + shift_z * cosa) / cur_box[4] + 0.5;
+            return;
+        }
+    }
+    for (int k = 0; k < boxes_num; k++){
+        if (check_pt_in_box3d(pts, shared_extend_boxes + k * 7, local_x, local_y)){
+            cls_labels[0] = -1;
+            return;
+        }
+    }
+}
+
+
+void assign_point_targets_launcher(int batch_size, int boxes_num, int pts_num, const float *boxes,
+    const float *extend_boxes, const float *pts, int *box_idx_of_points, int *cls_labels, float *part_labels){
+    // params boxes: (B, N, 7) [x, y, z, dx, dy, dz, heading] (x, y, z) is the box center
+    // params extend_boxes: (B, N, 7) the enlarged boxes
+    // params pts: (B, npoints, 3) [x, y, z]
+    // params boxes_idx_of_points: (B, npoints), default -1
+    // params cls_labels: (B, npoints), default 0
+    // params part_labels: (B, npoints, 3), default 0
+    cudaError_t err;
+
+    dim3 blocks(DIVUP(pts_num, THREADS_PER_BLOCK), batch_size);
+    dim3 threads(THREADS_PER_BLOCK);
+    size_t shared_mem_size = boxes_num * 7 * 2 * sizeof(float);
+    assign_point_targets_kernel<<<blocks, threads, shared_mem_size>>>(batch_size, boxes_num, pts_num, boxes,
+        extend_boxes, pts, box_idx_of_points, cls_labels, part_labels);
+
+    err = cudaGetLastError();
+    if (cudaSuccess != err) {
+        fprintf(stderr, "CUDA kernel failed : %s\n", cudaGetErrorString(err));
+        exit(-1);
+    }
+
+#ifdef DEBUG
+    cudaDeviceSynchronize();  // for using printf in kernel function
+#endif
+}
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Note:
+# - Checks assign_point_targets_gpu and points_in_boxes_gpu_hashed against the brute-force points_in_boxes_gpu
+#   and the torch part_labels_of_points reference, the roiaware_pool3d_cuda extension has to be rebuilt first
+# - Checks that PointHeadTemplate.assign_stack_targets gives the same labels on its cpu, fused and hashed paths
+
+import math
+import os
+import sys
+import torch
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(
+    os.path.dirname(__file__), os.path.pardir, os.path.pardir, os.path.pardir, os.path.pardir
+)))
+from lib.pcdet.ops.roiaware_pool3d import roiaware_pool3d_utils
+from lib.pcdet.models.dense_heads.point_head_template import PointHeadTemplate, part_labels_of_points
+
+
+def random_scene(batch_size=3, num_boxes=12, num_padded_boxes=3, num_points=4096, extra_width=0.4):
+    """
+    Returns:
+        points: (B, N, 3), half of them sampled around the boxes
+        gt_boxes: (B, M, 7), the last num_padded_boxes boxes of every sample but the first are zero-padded
+        extend_gt_boxes: (B, M, 7)
+    """
+    gt_boxes = torch.zeros(batch_size, num_boxes, 7)
+    gt_boxes[:, :, 0:2] = torch.rand(batch_size, num_boxes, 2) * 60 - 30
+    gt_boxes[:, :, 2] = torch.rand(batch_size, num_boxes) * 2 - 1
+    gt_boxes[:, :, 3:6] = torch.rand(batch_size, num_boxes, 3) * 4 + 1
+    gt_boxes[:, :, 6] = torch.rand(batch_size, num_boxes) * 2 * math.pi - math.pi
+    gt_boxes[1:, num_boxes - num_padded_boxes:] = 0
+
+    box_of_pts = torch.randint(0, num_boxes, (batch_size, num_points // 2))
+    near_points = gt_boxes.gather(1, box_of_pts.unsqueeze(dim=-1).expand(-1, -1, 7))
+    near_points = near_points[:, :, 0:3] + (torch.rand(batch_size, num_points // 2, 3) - 0.5) * \
+        (near_points[:, :, 3:6] + 2 * extra_width)
+    far_points = torch.rand(batch_size, num_points - num_points // 2, 3) * 64 - 32
+    far_points[:, :, 2] = torch.rand(batch_size, num_points - num_points // 2) * 6 - 3
+    points = torch.cat([near_points, far_points], dim=1)
+
+    extend_gt_boxes = gt_boxes.clone()
+    extend_gt_boxes[:, :, 3:6] += extra_width
+    return points.cuda().contiguous(), gt_boxes.cuda().contiguous(), extend_gt_boxes.cuda().contiguous()
+
+
+def assign_point_targets_reference(points, gt_boxes, extend_gt_boxes):
+    """
+    Per-sample brute-force target assignment, as done by assign_stack_targets before the fused kernel
+    Returns:
+        box_idxs_of_pts: (B, N)
+        point_cls_labels: (B, N)
+        point_part_labels: (B, N, 3)
+    """
+    box_idxs_list, cls_labels_list, part_labels_list = [], [], []
+    for k in range(points.shape[0]):
+        points_single = points[k]
+        box_idxs_of_pts = roiaware_pool3d_utils.points_in_boxes_gpu(
+            points_single.unsqueeze(dim=0), gt_boxes[k:k + 1]
+        ).long().squeeze(dim=0)
+        extend_box_idxs_of_pts = roiaware_pool3d_utils.points_in_boxes_gpu(
+            points_single.unsqueeze(dim=0), extend_gt_boxes[k:k + 1]
+        ).long().squeeze(dim=0)
+        fg_flag = (box_idxs_of_pts >= 0)
+        ignore_flag = fg_flag ^ (extend_box_idxs_of_pts >= 0)
+
+        point_cls_labels = box_idxs_of_pts.new_zeros(box_idxs_of_pts.shape)
+        point_cls_labels[ignore_flag] = -1
+        point_cls_labels[fg_flag] = 1
+
+        gt_box_of_fg_points = gt_boxes[k][box_idxs_of_pts[fg_flag]]
+        point_part_labels = points_single.new_zeros(points_single.shape)
+        point_part_labels[fg_flag] = part_labels_of_points(
+            points_single[fg_flag] - gt_box_of_fg_points[:, 0:3], gt_box_of_fg_points[:, 6],
+            gt_box_of_fg_points[:, [5, 3, 4]]
+        )
+
+        box_idxs_list.append(box_idxs_of_pts)
+        cls_labels_list.append(point_cls_labels)
+        part_labels_list.append(point_part_labels)
+    return torch.stack(box_idxs_list), torch.stack(cls_labels_list), torch.stack(part_labels_list)
+
+
+class RoIAwarePool3dTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_assign_point_targets_gpu(self):
+        for _ in range(5):
+            points, gt_boxes, extend_gt_boxes = random_scene()
+            box_idxs_of_pts, point_cls_labels, point_part_labels = roiaware_pool3d_utils.assign_point_targets_gpu(
+                points, gt_boxes, extend_gt_boxes
+            )
+            ref_box_idxs_of_pts, ref_cls_labels, ref_part_labels = assign_point_targets_reference(
+                points, gt_boxes, extend_gt_boxes
+            )
+            self.assertTrue((ref_cls_labels == 1).any() and (ref_cls_labels == -1).any())
+            self.assertTrue(torch.equal(box_idxs_of_pts.long(), ref_box_idxs_of_pts))
+            self.assertTrue(torch.equal(point_cls_labels.long(), ref_cls_labels))
+            # the kernel may contract the multiply-adds into fma, so allow for the last float ulps only
+            self.assertTrue(torch.allclose(point_part_labels, ref_part_labels, rtol=0, atol=1e-5))
+
+    def test_points_in_boxes_gpu_hashed(self):
+        for max_grid_size in [256, 4]:
+            points, gt_boxes, extend_gt_boxes = random_scene(num_boxes=40, num_padded_boxes=10)
+            box_idxs_of_pts = roiaware_pool3d_utils.points_in_boxes_gpu(points, gt_boxes)
+            hashed_box_idxs_of_pts = roiaware_pool3d_utils.points_in_boxes_gpu_hashed(
+                points, gt_boxes, max_grid_size=max_grid_size
+            )
+            self.assertTrue((box_idxs_of_pts >= 0).any())
+            self.assertTrue(torch.equal(hashed_box_idxs_of_pts, box_idxs_of_pts))
+
+            # with a known assignment both variants keep it and only test the remaining points
+            extend_box_idxs_of_pts = roiaware_pool3d_utils.points_in_boxes_gpu(
+                points, extend_gt_boxes, box_idxs_of_pts=box_idxs_of_pts
+            )
+            hashed_extend_box_idxs_of_pts = roiaware_pool3d_utils.points_in_boxes_gpu_hashed(
+                points, extend_gt_boxes, box_idxs_of_pts=box_idxs_of_pts, max_grid_size=max_grid_size
+            )
+            self.assertTrue(torch.equal(hashed_extend_box_idxs_of_pts, extend_box_idxs_of_pts))
+            self.assertTrue(torch.equal(
+                extend_box_idxs_of_pts >= 0, roiaware_pool3d_utils.points_in_boxes_gpu(points, extend_gt_boxes) >= 0
+            ))
+
+    def test_assign_stack_targets_paths(self):
+        model_cfgs = [
+            {'ASSIGN_TARGETS_ON_CPU': True},
+            {'ASSIGN_TARGETS_ON_CPU': False, 'USE_FUSED_TARGET_ASSIGN': True},
+            {'ASSIGN_TARGETS_ON_CPU': False, 'HASHED_POINTS_IN_BOXES_MIN_BOXES': 1},
+        ]
+        for _ in range(3):
+            points, gt_boxes, extend_gt_boxes = random_scene()
+            targets_list = [
+                PointHeadTemplate(model_cfg=model_cfg, num_class=1).assign_stack_targets(
+                    points, gt_boxes, extend_gt_boxes, ret_part_labels=True, set_ignore_flag=True
+                ) for model_cfg in model_cfgs
+            ]
+            ref_targets = targets_list[0]
+            self.assertTrue((ref_targets['point_cls_labels'] == 1).any())
+            for targets in targets_list[1:]:
+                self.assertTrue(torch.equal(targets['point_cls_labels'], ref_targets['point_cls_labels']))
+                self.assertTrue(torch.allclose(
+                    targets['point_part_labels'], ref_targets['point_part_labels'], rtol=0, atol=1e-5
+                ))
+
+
+if __name__ == '__main__':
+    unittest.main()
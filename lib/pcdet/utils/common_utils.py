@@ -58,18 +58,20 @@ def rotate_points_along_z(points, angle):
 def rotate_points_along_y(points, angle):
     """
     Args:
-        points: (B, N, 3 + C)
-        angle: (B), angle along z-axis, angle increases x ==> y
+        points: (N, 3 + C), rotated in place
+        angle: (N), angle along y-axis
     Returns:
+        points: (N, 3 + C)
     """
-
-    cosa = torch.cos(angle).view(-1,1) #N,1
-    sina = torch.sin(angle).view(-1,1) #N,1
-    raw_1=torch.cat([cosa,-sina],dim=1) #N,2
-    raw_2=torch.cat([sina,cosa],dim=1)  #N,2
-    R=torch.cat((raw_1.unsqueeze(dim=1),raw_2.unsqueeze(dim=1)),dim=1) #N,2,2
-    points_temp=points[:,[0,2]].unsqueeze(dim=1) #N,1,2
-    points[:,[0,2]]=torch.matmul(points_temp,R.permute(0,2,1)).squeeze(dim=1)
+    # only x and z change, so the 2x2 rotation is written out instead of building matrices for a bmm
+    # the columns are cloned, autograd may save them for backward and they are overwritten below
+    x, z = points[:, 0].clone(), points[:, 2].clone()
+    cosa = torch.cos(angle)
+    sina = torch.sin(angle)
+    x_rot = x * cosa - z * sina
+    z_rot = x * sina + z * cosa
+    points[:, 0] = x_rot
+    points[:, 2] = z_rot
 
     return points
 
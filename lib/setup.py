@@ -81,5 +81,13 @@ if __name__ == '__main__':
 
                 ],
             ),
+            make_cuda_ext(
+                name='roiaware_pool3d_cuda',
+                module='pcdet.ops.roiaware_pool3d',
+                sources=[
+                    'src/roiaware_pool3d.cpp',
+                    'src/roiaware_pool3d_kernel.cu',
+                ]
+            ),
         ],
     )